@@ -1,16 +1,22 @@
 import logging
 import asyncio
 import datetime
+import functools
 import html
+import itertools
 import os
-from pymongo import MongoClient
+import time
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from telegram import Update
-from telegram.constants import ParseMode
+from telegram.constants import MessageLimit, ParseMode
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, ContextTypes,
     MessageHandler, ChatMemberHandler, filters
 )
-from telegram.error import Forbidden
+from telegram.request import HTTPXRequest
+from telegram.error import Forbidden, RetryAfter, TelegramError
 
 # --- Carica dotenv solo in locale ---
 if os.getenv("RAILWAY_ENVIRONMENT") is None:
@@ -21,13 +27,56 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = os.getenv("DB_NAME")
 LOG_CHAT_ID = int(os.getenv("LOG_CHAT_ID", 0))  # Chat ID per log
+MAX_CONCURRENT = int(os.getenv("MAX_CONCURRENT", 15))  # chiamate Telegram in parallelo nei task
+
+ONE_DAY = 24 * 60 * 60  # secondi
+AUTO_BAN_INTERVAL = 60 * 60  # secondi tra due controlli di auto-ban
+ADMIN_STATUSES = frozenset({"administrator", "creator"})
+LEFT_STATUSES = frozenset({"left", "kicked"})
 
 if not BOT_TOKEN or not MONGO_URI:
     raise Exception("BOT_TOKEN o MONGO_URI non configurati!")
 
-mongo_client = MongoClient(MONGO_URI)
-db = mongo_client[DB_NAME]
-members_col = db["members"]
+# Limite condiviso dai task di manutenzione per non incorrere nel flood limit
+TELEGRAM_SEM = asyncio.Semaphore(MAX_CONCURRENT)
+
+# Per i task di manutenzione: su flood limit si attende e si riprova una volta
+async def retry_once(call):
+    try:
+        return await call()
+    except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        return await call()
+
+# Il client Motor viene creato in init_db(), dentro il loop di PTB
+mongo_client = None
+members_col = None
+
+async def init_db():
+    global mongo_client, members_col
+    # Pool dimensionato per le raffiche di scritture; w=1 basta per punti e presenze
+    mongo_client = AsyncIOMotorClient(
+        MONGO_URI,
+        maxPoolSize=50,
+        minPoolSize=5,
+        waitQueueTimeoutMS=2000,
+        retryWrites=True,
+        w=1
+    )
+    members_col = mongo_client[DB_NAME]["members"]
+
+    # Indici per lookup per utente, classifica, auto-ban e /listmembers.
+    # Un errore (es. user_id duplicati già presenti) non deve bloccare l'avvio.
+    indexes = [
+        ([("user_id", 1)], {"unique": True}),
+        ([("total_points", 1), ("created_at", 1)], {}),
+        ([("first_name", 1), ("user_id", 1)], {}),
+    ]
+    for keys, options in indexes:
+        try:
+            await members_col.create_index(keys, **options)
+        except Exception as e:
+            logger.error(f"Creazione indice {keys} fallita: {e}")
 
 # --- Logging ---
 logging.basicConfig(
@@ -37,9 +86,27 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Utility DB ---
-def add_or_update_member(user, chat, points_delta=0):
+# Proiezioni: solo i campi letti dagli handler
+RANKING_FIELDS = {"_id": 0, "user_id": 1, "first_name": 1, "total_points": 1}
+GROUP_FIELDS = {"_id": 0, "user_id": 1, "groups.chat_id": 1}
+
+# Profilo aggiornato a ogni scrittura; i valori iniziali solo alla creazione
+def profile_upsert(user, now):
+    return {
+        "$set": {
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name
+        },
+        "$setOnInsert": {"groups": [], "total_points": 0, "created_at": now}
+    }
+
+# Registra l'utente nel gruppo e restituisce il totale globale aggiornato.
+# Nessuna lettura preliminare: ogni passo è atomico, così i flush concorrenti
+# di flush_touches non possono duplicare né il membro né il gruppo.
+async def add_or_update_member(user, chat, points_delta=0):
     now = datetime.datetime.utcnow()
-    member = members_col.find_one({"user_id": user.id})
+    upsert = profile_upsert(user, now)
 
     group_info = {
         "chat_id": chat.id,
@@ -49,70 +116,87 @@ def add_or_update_member(user, chat, points_delta=0):
         "last_message_at": now
     }
 
-    if member:
-        members_col.update_one(
-            {"user_id": user.id},
+    for _ in range(3):
+        # Caso comune: utente già registrato nel gruppo, una sola scrittura
+        updated = await members_col.find_one_and_update(
+            {"user_id": user.id, "groups.chat_id": chat.id},
             {
-                "$set": {
-                    "username": user.username,
-                    "first_name": user.first_name,
-                    "last_name": user.last_name
-                }
-            }
+                "$inc": {
+                    "groups.$.points": points_delta,
+                    "total_points": points_delta
+                },
+                "$set": {**upsert["$set"], "groups.$.last_message_at": now}
+            },
+            projection={"_id": 0, "total_points": 1},
+            return_document=ReturnDocument.AFTER
         )
+        if updated is not None:
+            return updated["total_points"]
 
-        existing_group = next(
-            (g for g in member.get("groups", []) if g["chat_id"] == chat.id),
-            None
+        # Membro creato se manca, poi gruppo aggiunto solo se ancora assente
+        await members_col.update_one({"user_id": user.id}, upsert, upsert=True)
+        updated = await members_col.find_one_and_update(
+            {"user_id": user.id, "groups.chat_id": {"$ne": chat.id}},
+            {
+                "$push": {"groups": group_info},
+                "$inc": {"total_points": points_delta}
+            },
+            projection={"_id": 0, "total_points": 1},
+            return_document=ReturnDocument.AFTER
         )
+        if updated is not None:
+            return updated["total_points"]
+        # Il gruppo è stato aggiunto da un'altra scrittura nel frattempo: si riprova
 
-        if existing_group:
-            members_col.update_one(
-                {"user_id": user.id, "groups.chat_id": chat.id},
-                {
-                    "$inc": {
-                        "groups.$.points": points_delta,
-                        "total_points": points_delta
-                    },
-                    "$set": {"groups.$.last_message_at": now}
-                }
-            )
-        else:
-            members_col.update_one(
-                {"user_id": user.id},
-                {
-                    "$push": {"groups": group_info},
-                    "$inc": {"total_points": points_delta}
-                }
-            )
-    else:
-        members_col.insert_one({
-            "user_id": user.id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "groups": [group_info],
-            "total_points": points_delta,
-            "created_at": now
-        })
+    raise RuntimeError(f"Aggiornamento del membro {user.id} in {chat.id} non riuscito")
 
 # --- Controllo admin ---
+ADMIN_TTL = 60  # secondi di validità della cache admin
+ADMIN_TIMEOUT = 3  # secondi massimi per get_member
+_admin_cache: dict[tuple[int, int], tuple[float, bool]] = {}
+
 async def is_admin(update: Update) -> bool:
     chat = update.effective_chat
     user = update.effective_user
     if not chat or not user:
         return False
-    try:
-        member = await chat.get_member(user.id)
-        return member.status in ("administrator", "creator")
-    except Exception:
-        return False
+
+    key = (chat.id, user.id)
+    ts, cached = _admin_cache.get(key, (0, None))
+    if time.time() - ts < ADMIN_TTL:
+        return cached
+
+    for attempt in range(2):
+        try:
+            member = await asyncio.wait_for(chat.get_member(user.id), timeout=ADMIN_TIMEOUT)
+            break
+        except RetryAfter as e:
+            # Flood limit: si riprova una volta solo se l'attesa è breve,
+            # altrimenti si bloccherebbero tutti gli update in coda
+            if attempt or e.retry_after > ADMIN_TIMEOUT:
+                logger.warning(f"Controllo admin rinviato per flood limit ({e.retry_after}s) per {user.id} in {chat.id}")
+                return False
+            await asyncio.sleep(e.retry_after)
+        except (TelegramError, asyncio.TimeoutError) as e:
+            logger.warning(f"Controllo admin fallito per {user.id} in {chat.id}: {e}")
+            return False
+
+    result = member.status in ADMIN_STATUSES
+    _admin_cache[key] = (time.time(), result)
+    return result
+
+# --- Formattazione ---
+@functools.lru_cache(maxsize=4096)
+def mention(user_id, name):
+    return f"<a href='tg://user?id={user_id}'>{html.escape(name or 'Utente')}</a>"
 
 # --- Comandi Telegram ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    add_or_update_member(update.message.from_user, update.effective_chat)
+    await add_or_update_member(update.message.from_user, update.effective_chat)
     await update.message.reply_text("🤖 Ciao! Sto tracciando utenti e punti globalmente.")
 
+MAX_POINTS = 1000  # punti massimi assegnabili con un singolo /punto
+
 async def punto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
         await update.message.reply_text("Solo gli amministratori possono assegnare punti.")
@@ -125,12 +209,19 @@ async def punto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.reply_to_message.from_user
     chat = update.effective_chat
     points = 1
-    if context.args and context.args[0].isdigit():
-        points = int(context.args[0])
+    if context.args:
+        # isdigit() accetta anche '²', che int() rifiuta
+        try:
+            points = int(context.args[0])
+        except ValueError:
+            points = 0
+        if not 1 <= points <= MAX_POINTS:
+            await update.message.reply_text(
+                f"Uso: /punto [numero da 1 a {MAX_POINTS}], in risposta a un messaggio."
+            )
+            return
 
-    add_or_update_member(user, chat, points_delta=points)
-    member = members_col.find_one({"user_id": user.id})
-    total = member.get("total_points", 0)
+    total = await add_or_update_member(user, chat, points_delta=points)
 
     await update.message.reply_html(
         f"✅ {html.escape(user.first_name)} ha ricevuto <b>{points}</b> punti!\n"
@@ -144,27 +235,67 @@ async def punto(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 async def global_ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    top = list(members_col.find().sort("total_points", -1).limit(10))
+    top = await members_col.find({}, RANKING_FIELDS).sort("total_points", -1).limit(10).to_list(length=None)
     if not top:
         await update.message.reply_text("Nessun membro registrato.")
         return
 
-    msg = "<b>🏆 Classifica Globale</b>\n"
+    parts = ["<b>🏆 Classifica Globale</b>\n"]
     for i, m in enumerate(top, start=1):
-        name = html.escape(m.get("first_name", "Utente"))
-        msg += f"{i}. <a href='tg://user?id={m['user_id']}'>{name}</a> — {m.get('total_points', 0)} punti\n"
+        parts.append(f"{i}. {mention(m['user_id'], m.get('first_name'))} — {m.get('total_points', 0)} punti\n")
+    msg = "".join(parts)
     await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
 
+# Telegram misura il limite in unità UTF-16, sul testo dopo il parsing dell'HTML
+def tg_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
 async def list_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    members = list(members_col.find().sort("first_name", 1))
-    if not members:
-        await update.message.reply_text("Nessun membro registrato.")
+    page = 1
+    if context.args:
+        try:
+            page = int(context.args[0])
+        except ValueError:
+            page = 0
+    if page < 1:
+        await update.message.reply_text("Pagina non valida.")
+        return
+
+    title = f"👥 Membri registrati globalmente (pagina {page}):"
+    footer = f"\nInvia /listmembers {page + 1} per la pagina successiva."
+    budget = MessageLimit.MAX_TEXT_LENGTH - tg_len(title + "\n") - tg_len(footer)
+
+    # Le pagine si riempiono fino al limite di Telegram, quindi quelle
+    # precedenti vanno scorse; user_id rende l'ordine stabile tra omonimi
+    cursor = members_col.find({}, RANKING_FIELDS).sort([("first_name", 1), ("user_id", 1)])
+    parts, current, used, has_next = [], 1, 0, False
+    i = 0
+    async for m in cursor:
+        i += 1
+        points = m.get("total_points", 0)
+        size = tg_len(f"{i}. {m.get('first_name') or 'Utente'} — {points} punti\n")
+        if used + size > budget:
+            if current == page:
+                has_next = True
+                break
+            current += 1
+            used = 0
+        used += size
+        if current == page:
+            parts.append(f"{i}. {mention(m['user_id'], m.get('first_name'))} — {points} punti\n")
+    await cursor.close()
+
+    if not parts:
+        if page == 1:
+            await update.message.reply_text("Nessun membro registrato.")
+        else:
+            await update.message.reply_text("Pagina non valida.")
         return
 
-    msg = "<b>👥 Membri registrati globalmente:</b>\n"
-    for i, m in enumerate(members, start=1):
-        name = html.escape(m.get("first_name", "Utente"))
-        msg += f"{i}. <a href='tg://user?id={m['user_id']}'>{name}</a> — {m.get('total_points', 0)} punti\n"
+    parts.insert(0, f"<b>{title}</b>\n")
+    if has_next:
+        parts.append(footer)
+    msg = "".join(parts)
     await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
 
 # --- Gestione messaggi ---
@@ -173,7 +304,72 @@ async def track_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     if not user or not chat:
         return
-    add_or_update_member(user, chat)
+
+    # Scrittura rimandata: flush_touches la raggruppa con le altre
+    pending_touches[(chat.id, user.id)] = (user, chat, datetime.datetime.utcnow())
+
+# --- Coda presenze ---
+FLUSH_INTERVAL = 0.5  # secondi tra due flush
+FLUSH_BATCH = 500  # presenze massime per bulk_write
+# Presenze in attesa per (chat_id, user_id); l'ultima sovrascrive le precedenti
+pending_touches: dict[tuple[int, int], tuple] = {}
+# Serializza i flush con le rimozioni di member_status_update
+touch_lock = asyncio.Lock()
+
+# Stesso effetto di add_or_update_member con 0 punti; operazioni idempotenti
+def touch_ops(user, chat, now):
+    return [
+        UpdateOne({"user_id": user.id}, profile_upsert(user, now), upsert=True),
+        UpdateOne(
+            {"user_id": user.id, "groups.chat_id": chat.id},
+            {"$set": {"groups.$.last_message_at": now}}
+        ),
+        UpdateOne(
+            {"user_id": user.id, "groups.chat_id": {"$ne": chat.id}},
+            {"$push": {"groups": {
+                "chat_id": chat.id,
+                "title": chat.title,
+                "joined_at": now,
+                "points": 0,
+                "last_message_at": now
+            }}}
+        )
+    ]
+
+def requeue_touches(entries):
+    # Una presenza più recente arrivata nel frattempo ha la precedenza
+    for key, item in entries:
+        pending_touches.setdefault(key, item)
+
+# Restituisce False se il flush non ha scritto nulla e ha rimesso tutto in coda
+async def flush_pending_touches():
+    async with touch_lock:
+        keys = list(itertools.islice(pending_touches, FLUSH_BATCH))
+        if not keys:
+            return True
+        batch = [(key, pending_touches.pop(key)) for key in keys]
+
+        ops = [op for _, item in batch for op in touch_ops(*item)]
+        try:
+            # ordered: per ogni utente l'upsert deve precedere l'aggiornamento dei gruppi
+            await members_col.bulk_write(ops, ordered=True)
+        except BulkWriteError as e:
+            # Mongo si ferma al primo errore: si scarta la presenza che lo ha
+            # causato e si rimettono in coda quelle non ancora applicate
+            error = e.details["writeErrors"][0]
+            failed = error["index"] // (len(ops) // len(batch))
+            logger.error(f"Errore scrittura presenza {batch[failed][0]}: {error.get('errmsg')}")
+            requeue_touches(batch[failed + 1:])
+        except Exception as e:
+            logger.error(f"Errore scrittura presenze: {e}")
+            requeue_touches(batch)
+            return False
+        return True
+
+async def flush_touches():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush_pending_touches()
 
 # --- Gestione uscite in tempo reale ---
 async def member_status_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -181,11 +377,18 @@ async def member_status_update(update: Update, context: ContextTypes.DEFAULT_TYP
     user = update.chat_member.new_chat_member.user
     chat = update.effective_chat
 
-    if new_status in ("left", "kicked"):
-        members_col.update_one(
-            {"user_id": user.id},
-            {"$pull": {"groups": {"chat_id": chat.id}}}
-        )
+    # Il ruolo è cambiato: la cache admin va invalidata
+    _admin_cache.pop((chat.id, user.id), None)
+
+    if new_status in LEFT_STATUSES:
+        # Il lock attende un flush in corso; la presenza in attesa viene scartata
+        # così non può reinserire il gruppo dopo il $pull
+        async with touch_lock:
+            pending_touches.pop((chat.id, user.id), None)
+            await members_col.update_one(
+                {"user_id": user.id},
+                {"$pull": {"groups": {"chat_id": chat.id}}}
+            )
         if LOG_CHAT_ID:
             await context.bot.send_message(
                 chat_id=LOG_CHAT_ID,
@@ -194,85 +397,165 @@ async def member_status_update(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # --- Pulizia automatica utenti usciti ---
 async def clean_inactive_members(app):
+    async def check(user_id, chat_id):
+        async with TELEGRAM_SEM:
+            try:
+                chat_member = await retry_once(lambda: app.bot.get_chat_member(chat_id, user_id))
+            except Forbidden:
+                return None
+            except Exception as e:
+                logger.error(f"Errore durante il controllo {user_id} in {chat_id}: {e}")
+                return None
+
+            if chat_member.status not in LEFT_STATUSES:
+                return None
+            return user_id, chat_id, chat_member.user.full_name
+
+    async def log_removal(user_id, chat_id, full_name):
+        async with TELEGRAM_SEM:
+            try:
+                await retry_once(lambda: app.bot.send_message(
+                    LOG_CHAT_ID,
+                    f"⚠️ {full_name} non è più presente in {chat_id}, rimosso dal DB"
+                ))
+            except Exception as e:
+                logger.error(f"Errore invio log pulizia {user_id}: {e}")
+
     await asyncio.sleep(120)
     while True:
         logger.info("🧹 Avvio pulizia utenti non più presenti nei gruppi...")
-        all_members = list(members_col.find())
-        for member in all_members:
-            user_id = member["user_id"]
-            for group in member.get("groups", []):
-                chat_id = group["chat_id"]
-                try:
-                    chat_member = await app.bot.get_chat_member(chat_id, user_id)
-                    if chat_member.status in ("left", "kicked"):
-                        members_col.update_one(
-                            {"user_id": user_id},
-                            {"$pull": {"groups": {"chat_id": chat_id}}}
-                        )
-                        if LOG_CHAT_ID:
-                            await app.bot.send_message(
-                                LOG_CHAT_ID,
-                                f"⚠️ {chat_member.user.full_name} non è più presente in {chat_id}, rimosso dal DB"
-                            )
-                except Forbidden:
-                    continue
-                except Exception as e:
-                    logger.error(f"Errore durante il controllo {user_id} in {chat_id}: {e}")
-        await asyncio.sleep(86400)  # ogni 24 ore
+        # Solo chi risulta ancora in almeno un gruppo: il filtro resta su Mongo
+        all_members = await members_col.find(
+            {"groups.0": {"$exists": True}}, GROUP_FIELDS
+        ).to_list(length=None)
+        results = await asyncio.gather(*(
+            check(member["user_id"], group["chat_id"])
+            for member in all_members
+            for group in member.get("groups", [])
+        ))
+        departed = [r for r in results if r is not None]
+
+        # Tutte le rimozioni del giro in un'unica scrittura, log solo se riuscita
+        if departed:
+            try:
+                await members_col.bulk_write([
+                    UpdateOne(
+                        {"user_id": user_id},
+                        {"$pull": {"groups": {"chat_id": chat_id}}}
+                    )
+                    for user_id, chat_id, _ in departed
+                ], ordered=False)
+            except Exception as e:
+                logger.error(f"Errore rimozione utenti usciti: {e}")
+            else:
+                if LOG_CHAT_ID:
+                    await asyncio.gather(*(log_removal(*r) for r in departed))
+        await asyncio.sleep(ONE_DAY)
 
 # --- Auto-ban utenti 0 punti da 24 ore ---
 async def auto_tasks(app):
+    async def fetch_admins(chat_id):
+        async with TELEGRAM_SEM:
+            try:
+                admins = await retry_once(lambda: app.bot.get_chat_administrators(chat_id))
+                return chat_id, {a.user.id for a in admins}
+            except Forbidden:
+                return chat_id, None
+            except Exception as e:
+                logger.error(f"Errore lettura admin {chat_id}: {e}")
+                return chat_id, None
+
+    async def ban(user_id, chat_id):
+        async with TELEGRAM_SEM:
+            try:
+                await retry_once(lambda: app.bot.ban_chat_member(chat_id, user_id))
+            except Forbidden:
+                return
+            except Exception as e:
+                logger.error(f"Errore ban {user_id}: {e}")
+                return
+
+            if LOG_CHAT_ID:
+                try:
+                    await retry_once(lambda: app.bot.send_message(
+                        LOG_CHAT_ID,
+                        f"🚫 Bannato {user_id} da {chat_id} (0 punti da 24 ore)"
+                    ))
+                except Exception as e:
+                    logger.error(f"Errore invio log ban {user_id}: {e}")
+
     while True:
         now = datetime.datetime.utcnow()
-        one_day_ago = now - datetime.timedelta(days=1)  # 24 ore
+        one_day_ago = now - datetime.timedelta(seconds=ONE_DAY)
 
-        users = list(members_col.find({
+        users = await members_col.find({
             "total_points": 0,
-            "created_at": {"$lte": one_day_ago}
-        }))
-
-        for user in users:
-            for g in user.get("groups", []):
-                try:
-                    member = await app.bot.get_chat_member(g["chat_id"], user["user_id"])
-                    if member.status not in ("administrator", "creator"):
-                        await app.bot.ban_chat_member(g["chat_id"], user["user_id"])
-                        if LOG_CHAT_ID:
-                            await app.bot.send_message(
-                                LOG_CHAT_ID,
-                                f"🚫 Bannato {user['user_id']} da {g['chat_id']} (0 punti da 24 ore)"
-                            )
-                except Forbidden:
-                    pass
-                except Exception as e:
-                    logger.error(f"Errore ban {user['user_id']}: {e}")
-
-        await asyncio.sleep(3600)  # controllo ogni 24 ore
+            "created_at": {"$lte": one_day_ago},
+            "groups.0": {"$exists": True}
+        }, GROUP_FIELDS).to_list(length=None)
+
+        # Admin di ogni gruppo letti una sola volta per giro, non per utente
+        chat_ids = {g["chat_id"] for u in users for g in u.get("groups", [])}
+        admins_by_chat = dict(await asyncio.gather(*(fetch_admins(c) for c in chat_ids)))
+
+        await asyncio.gather(*(
+            ban(u["user_id"], g["chat_id"])
+            for u in users
+            for g in u.get("groups", [])
+            if admins_by_chat[g["chat_id"]] is not None
+            and u["user_id"] not in admins_by_chat[g["chat_id"]]
+        ))
+
+        await asyncio.sleep(AUTO_BAN_INTERVAL)
+
+# --- Avvio ---
+async def post_init(app):
+    # Eseguito da PTB dentro il suo loop, prima del polling
+    await init_db()
+    app.create_task(flush_touches())
+    app.create_task(auto_tasks(app))
+    app.create_task(clean_inactive_members(app))
+    logger.info("✅ Task di manutenzione avviati correttamente.")
+
+async def post_shutdown(app):
+    # Salva le presenze ancora in coda prima di uscire, finché Mongo risponde
+    while pending_touches and await flush_pending_touches():
+        pass
 
 # --- MAIN ---
 if __name__ == "__main__":
     import sys
     if sys.platform == "win32":
-        import asyncio
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-    app_ = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Connessioni riusate (HTTP/2) per risposte e raffiche dei task di manutenzione
+    request = HTTPXRequest(
+        connection_pool_size=max(64, MAX_CONCURRENT),
+        http_version="2",
+        connect_timeout=5,
+        read_timeout=10
+    )
+
+    app_ = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Handlers
     app_.add_handler(CommandHandler("start", start))
     app_.add_handler(CommandHandler("globalranking", global_ranking))
     app_.add_handler(CommandHandler("listmembers", list_members))
     app_.add_handler(CommandHandler("punto", punto))
-    app_.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, track_message))
+    # I messaggi di servizio (es. left_chat_member) non sono presenze
+    app_.add_handler(MessageHandler(
+        filters.ALL & ~filters.COMMAND & ~filters.StatusUpdate.ALL, track_message
+    ))
     app_.add_handler(ChatMemberHandler(member_status_update, ChatMemberHandler.CHAT_MEMBER))
 
-    # Task di manutenzione
-    async def start_auto_tasks(app__):
-        app__.create_task(auto_tasks(app__))
-        app__.create_task(clean_inactive_members(app__))
-        logger.info("✅ Task di manutenzione avviati correttamente.")
-
-    app_.post_init = start_auto_tasks
-
     logger.info("🤖 Bot avviato e in ascolto su Railway!")
-    app_.run_polling()
+    # chat_member non è incluso negli update di default di Telegram
+    app_.run_polling(allowed_updates=Update.ALL_TYPES)